@@ -0,0 +1,235 @@
+"""Columnar export of archive segments.
+
+The JSONL archive remains authoritative. Each segment can be exported
+to a set of fixed-width column files, one per field, that can be
+memory-mapped and read without copying:
+
+    columnar/<epoch_year>/<segment>/time.q      int64, time (ms)
+    columnar/<epoch_year>/<segment>/current.d   float64, current value
+    columnar/<epoch_year>/<segment>/average.d   float64, average (NaN if none)
+    columnar/<epoch_year>/<segment>/offset.q    int64, byte offset of the
+                                                signed record in the segment
+
+Values are stored in native byte order. The signature for a row can be
+retrieved by reading the line at `offset` in the JSONL segment.
+"""
+
+import argparse
+import json
+import logging
+import math
+import mmap
+import os
+
+from array import array
+from pathlib import Path
+from typing import Final
+
+import config
+import helpers
+
+logger = logging.getLogger(config.UVICORN_LOGGER)
+
+
+columnar: Final[str] = "columnar"
+COLUMNS: Final[dict] = {
+    "time": "q",
+    "current": "d",
+    "average": "d",
+    "offset": "q",
+}
+
+
+class ColumnarError(Exception):
+    """Raised when column files are inconsistent with each other."""
+
+
+def segment_dir(segment: str) -> str:
+    """Return the columnar directory for an archive segment."""
+    path = Path(segment)
+    return os.path.join(columnar, path.parent.name, path.stem)
+
+
+def column_file(directory: str, name: str) -> str:
+    """Return the path to a column file."""
+    return os.path.join(directory, f"{name}.{COLUMNS[name]}")
+
+
+def record_row(data: dict, offset: int) -> dict:
+    """Return a row for the given record data."""
+    return {
+        "time": data["time"],
+        "current": data["current"],
+        "average": data.get("average", math.nan),
+        "offset": offset,
+    }
+
+
+def export_segment(segment: str, directory: str = None) -> int:
+    """Export an archive segment to column files.
+
+    Returns the number of rows exported.
+    """
+    if directory is None:
+        directory = segment_dir(segment)
+    columns = {name: array(typecode) for name, typecode in COLUMNS.items()}
+    offset = 0
+    with open(segment, "rb") as reader:
+        for line in reader:
+            record_offset = offset
+            offset += len(line)
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("skipping unreadable line at offset: %s", record_offset)
+                continue
+            data = record.get("data")
+            if not isinstance(data, dict) or "time" not in data:
+                # Key data.
+                continue
+            for name, value in record_row(data, record_offset).items():
+                columns[name].append(value)
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    for name, column in columns.items():
+        helpers.write_atomic(column_file(directory, name), column.tobytes())
+    rows = len(columns["time"])
+    logger.info("exported %s rows from %s to %s", rows, segment, directory)
+    return rows
+
+
+def sidecar_consistent(segment: str, offset: int) -> bool:
+    """Return True if the column files of a segment hold every record
+    before `offset`.
+    """
+    directory = segment_dir(segment)
+    try:
+        sizes = {os.path.getsize(column_file(directory, name)) for name in COLUMNS}
+    except FileNotFoundError:
+        return False
+    if len(sizes) != 1:
+        return False
+    size = sizes.pop()
+    if size == 0:
+        return offset == 0
+    last = array(COLUMNS["offset"])
+    with open(column_file(directory, "offset"), "rb") as column:
+        column.seek(size - last.itemsize)
+        last.frombytes(column.read(last.itemsize))
+    # The last row must be the record immediately before `offset`.
+    with open(segment, "rb") as reader:
+        reader.seek(last[0])
+        reader.readline()
+        reader.readline()
+        return reader.tell() == offset
+
+
+def append_record(segment: str, data: dict, offset: int):
+    """Append a record to the column files of an archive segment.
+
+    Column files that are missing, have different lengths, or do not
+    end at the previous record, e.g. after a crash or when the sidecar
+    is enabled partway through a segment, are rebuilt from the segment
+    instead.
+    """
+    if not sidecar_consistent(segment, offset):
+        export_segment(segment)
+        return
+    directory = segment_dir(segment)
+    for name, value in record_row(data, offset).items():
+        with open(column_file(directory, name), "ab") as column:
+            column.write(array(COLUMNS[name], [value]).tobytes())
+
+
+class ColumnarSegment:
+    """Memory-mapped, read-only view of an exported segment.
+
+    Columns are exposed as memoryviews over the mapped files, e.g.:
+
+        with ColumnarSegment(directory) as segment:
+            times = segment.columns["time"]
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.columns = {}
+        self._maps = []
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.columns.get("time", []))
+
+    def open(self):
+        """Map the column files into memory.
+
+        Raises ColumnarError if a column is missing or holds a partial
+        row, or if the columns differ in length or do not start at the
+        beginning of the segment.
+        """
+        try:
+            for name, typecode in COLUMNS.items():
+                self._map_column(name, typecode)
+            lengths = {len(view) for view in self.columns.values()}
+            offsets = self.columns["offset"]
+            if len(lengths) != 1 or (len(offsets) and offsets[0] != 0):
+                raise ColumnarError(f"inconsistent column files in: {self.directory}")
+        except BaseException:
+            self.close()
+            raise
+
+    def _map_column(self, name: str, typecode: str):
+        """Map a single column file into memory."""
+        path = column_file(self.directory, name)
+        try:
+            column = open(path, "rb")
+        except FileNotFoundError as err:
+            raise ColumnarError(f"missing column file: {path}") from err
+        with column:
+            size = os.fstat(column.fileno()).st_size
+            if size % array(typecode).itemsize:
+                raise ColumnarError(f"partial row in column file: {path}")
+            if size == 0:
+                self.columns[name] = memoryview(array(typecode))
+                return
+            mapped = mmap.mmap(column.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        self.columns[name] = memoryview(mapped).cast(typecode)
+
+    def close(self):
+        """Release the columns and unmap the column files."""
+        for view in self.columns.values():
+            view.release()
+        self.columns = {}
+        for mapped in self._maps:
+            mapped.close()
+        self._maps = []
+
+
+def main():
+    """Primary entry point for this script."""
+
+    parser = argparse.ArgumentParser(
+        prog="Orcfax Express (Columnar)",
+        description="export archive segments to columnar files",
+        epilog="for more information visit https://orcfax.io/",
+    )
+
+    parser.add_argument(
+        "segments",
+        help="archive segments (JSONL) to export",
+        nargs="+",
+    )
+
+    args = parser.parse_args()
+
+    for segment in args.segments:
+        export_segment(segment)
+
+
+if __name__ == "__main__":
+    main()
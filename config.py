@@ -3,3 +3,18 @@
 from typing import Final
 
 UVICORN_LOGGER: Final[str] = "uvicorn.error"
+
+# Write columnar sidecar files alongside the archive, see `columnar.py`.
+COLUMNAR_SIDECAR: Final[bool] = False
+
+# Environment variable holding the URL of a leader node to follow, see
+# `follower.py`.
+LEADER_ENV: Final[str] = "ORCFAX_LEADER"
+
+# Environment variable holding comma separated ed25519 public keys (hex)
+# of the leader that a follower trusts.
+LEADER_PKEY_ENV: Final[str] = "ORCFAX_LEADER_PKEY"
+
+# Environment variable allowing a follower to accept a new leader key
+# that the leader reports via `/pkey`.
+ALLOW_KEY_ROTATION_ENV: Final[str] = "ORCFAX_ALLOW_KEY_ROTATION"
@@ -0,0 +1,492 @@
+"""Follower nodes.
+
+A follower replicates the archive of a leader node rather than
+generating and signing its own data. The leader's archive segments are
+listed via `/replicate` and tailed via `/replicate/{segment}` using a
+byte cursor, i.e. the size of the follower's copy of each segment.
+
+Records are only accepted when signed by a trusted leader key. Keys are
+trusted when configured explicitly, when restored from records already
+verified in the local archive, or on first use from the leader's
+`/pkey`. A new key is only accepted if key rotation is allowed, the
+leader currently reports it, and the rotation is logged.
+
+Segments that fail verification are stalled rather than retried until
+`FollowerRunner.stall_expiry` has passed. Feeds whose latest segment is
+stalled are reported as unavailable rather than served stale, and
+stalled segments are listed by `/replicate/status`. Unexpected responses
+from the leader are retried with backoff.
+"""
+
+import asyncio
+import binascii
+import http.client
+import json
+import logging
+import os
+import re
+import time
+
+from pathlib import Path
+from typing import Final
+from urllib.parse import quote, urlsplit
+
+from cryptography import exceptions
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+from cryptography.hazmat.primitives import serialization
+
+import config
+import helpers
+
+logger = logging.getLogger(config.UVICORN_LOGGER)
+
+
+feed_files: Final[tuple] = (helpers.data_feed_file_one, helpers.data_feed_file_two)
+segment_pattern: Final[re.Pattern] = re.compile(
+    r"^\d+/\d+-datafeed_(one|two)\.jsonl$", re.ASCII
+)
+
+
+class ReplicationError(Exception):
+    """Raised when data received from a leader cannot be replicated."""
+
+
+class LeaderError(Exception):
+    """Raised when a leader responds unexpectedly, e.g. while it
+    restarts.
+    """
+
+
+def verify_record(signed: dict, pkey_data: dict):
+    """Verify a signed data structure against its archived key data."""
+    try:
+        pkey = Ed25519PublicKey.from_public_bytes(
+            binascii.unhexlify(pkey_data["ed25519"])
+        )
+        pkey.verify(binascii.unhexlify(signed["signature"]), signed["payload"].encode())
+        payload = json.loads(binascii.unhexlify(signed["payload"]))
+    except (
+        KeyError,
+        TypeError,
+        ValueError,
+        AttributeError,
+        binascii.Error,
+        exceptions.InvalidSignature,
+    ) as err:
+        raise ReplicationError(f"record failed verification: {err}") from err
+    if payload != signed.get("data"):
+        raise ReplicationError("record data does not match signed payload")
+    if not isinstance(payload, dict) or not {"feed_id", "time"} <= payload.keys():
+        raise ReplicationError("record data is missing feed_id or time")
+
+
+def parse_records(chunk: bytes) -> tuple:
+    """Pair the lines of a chunk into (signed, key data) records.
+
+    Lines that are not valid JSON are torn writes, e.g. from a crash
+    on the leader, and are skipped. Pairing resumes at the next signed
+    line followed by a key line. Valid lines that cannot be paired are
+    only tolerated next to a torn line.
+
+    Returns the records and the number of lines skipped.
+    """
+    parsed = []
+    for line in chunk.split(b"\n")[:-1]:
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            obj = None
+        parsed.append(obj if isinstance(obj, dict) else None)
+    torn = {idx for idx, obj in enumerate(parsed) if obj is None}
+    records = []
+    unpaired = []
+    idx = 0
+    while idx < len(parsed):
+        obj = parsed[idx]
+        key = parsed[idx + 1] if idx + 1 < len(parsed) else None
+        if obj is not None and "signature" in obj and key and "ed25519" in key:
+            records.append((obj, key))
+            idx += 2
+            continue
+        if obj is not None:
+            unpaired.append(idx)
+        idx += 1
+    for idx in unpaired:
+        if idx - 1 not in torn and idx + 1 not in torn:
+            raise ReplicationError(f"unpaired record at line {idx} of chunk")
+    return records, len(torn) + len(unpaired)
+
+
+class RemoteKey:
+    """Public key of a leader as recorded in its archive."""
+
+    def __init__(self, pkey_data: dict = None):
+        self.data = pkey_data if pkey_data else {}
+
+    @classmethod
+    def from_ed25519(cls, ed25519: str):
+        """Create a key from its ed25519 hex representation."""
+        raw = binascii.unhexlify(ed25519)
+        if len(raw) != 32:
+            raise ValueError(f"invalid ed25519 public key: {ed25519}")
+        # CBOR encoding of a 32 byte string.
+        return cls({"ed25519": ed25519, "cbor": f"5820{ed25519}"})
+
+    @property
+    def pkey_cbor(self) -> str:
+        """Return pkey as cbor."""
+        return self.data.get("cbor", "")
+
+    @property
+    def pkey_ed25519(self) -> str:
+        """Return pkey as ed25519."""
+        return self.data.get("ed25519", "")
+
+    def pkey_as_data(self) -> dict:
+        """Return pkey as data + other representations."""
+        return dict(self.data)
+
+    def pkey_as_pem(self) -> str:
+        """Return pkey as PEM."""
+        if not self.data:
+            return ""
+        ed25519 = Ed25519PublicKey.from_public_bytes(
+            binascii.unhexlify(self.data["ed25519"])
+        )
+        return ed25519.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+
+
+def segment_file_name(segment: str) -> str:
+    """Return the feed file name an archive segment was written for."""
+    return Path(segment).name.split("-", 1)[-1].replace("jsonl", "json")
+
+
+def segment_path(segment: str) -> str:
+    """Return the local archive path of a segment named by the leader.
+
+    Only names the leader itself would write are accepted, and the path
+    must resolve within the archive, see `main.replicate`.
+    """
+    if not segment_pattern.match(segment):
+        raise ReplicationError(f"invalid segment name: {segment!r}")
+    base = Path(helpers.archive).resolve()
+    path = (base / segment).resolve()
+    if not path.is_relative_to(base):
+        raise ReplicationError(f"segment outside of the archive: {segment!r}")
+    return str(path)
+
+
+def segment_order(segment: str) -> tuple:
+    """Return a key ordering archive segments chronologically."""
+    path = Path(segment)
+    day, _, name = path.name.partition("-")
+    try:
+        return (int(path.parent.name), int(day), name)
+    except ValueError:
+        return (0, 0, path.as_posix())
+
+
+class FollowerRunner(helpers.BackgroundRunner):
+    """Replicate the archive of a leader node.
+
+    Network access, verification and archive writes happen in a worker
+    thread. Served state is only updated on the event loop, see
+    `apply`.
+    """
+
+    follow_interval: Final[int] = 5
+    batch_size: Final[int] = 1024 * 1024
+    timeout: Final[int] = 30
+    retry_max: Final[int] = 300
+    stall_expiry: Final[int] = 3600
+
+    def __init__(self, leader: str, pkeys: list = None, allow_rotation=False):
+        self.leader = urlsplit(leader)
+        if self.leader.scheme not in ("http", "https") or not self.leader.hostname:
+            raise ValueError(f"leader must be an http(s) URL: {leader}")
+        self.connection = None
+        self.trusted = {}
+        for ed25519 in pkeys or []:
+            pkey = RemoteKey.from_ed25519(ed25519)
+            self.trusted[pkey.pkey_ed25519] = pkey.data
+        self.allow_rotation = allow_rotation
+        self.stalled = {}
+        self.heads = {}
+        self.latest = {}
+        super().__init__(keypair=RemoteKey())
+
+    def publish_keys(self):
+        """Publish the leader's public key document once it is known."""
+        if self.keypair.data:
+            super().publish_keys()
+
+    @property
+    def valuedata(self):
+        """Return the leader's most recent signed data."""
+        return self.latest.get(helpers.data_feed_file_one, {})
+
+    @property
+    def valuedata_debug(self):
+        """Return the leader's most recent signed data.
+
+        Followers cannot sign so there is nothing further to debug.
+        """
+        return self.valuedata
+
+    @property
+    def pluraldata(self):
+        """Return the leader's most recent signed pluralized data."""
+        return self.latest.get(helpers.data_feed_file_two, {})
+
+    def disconnect(self):
+        """Close the connection to the leader."""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def get(self, path: str) -> tuple:
+        """Request a path from the leader, reusing the connection.
+
+        Returns the response and its body.
+        """
+        if self.connection is None:
+            if self.leader.scheme == "https":
+                connection = http.client.HTTPSConnection
+            else:
+                connection = http.client.HTTPConnection
+            self.connection = connection(
+                self.leader.hostname, self.leader.port, timeout=self.timeout
+            )
+        try:
+            self.connection.request("GET", f"{self.leader.path.rstrip('/')}{path}")
+            response = self.connection.getresponse()
+            return response, response.read()
+        except Exception:
+            self.disconnect()
+            raise
+
+    def leader_pkey(self) -> dict:
+        """Return the key data the leader currently reports."""
+        response, body = self.get("/pkey")
+        if response.status != 200:
+            raise LeaderError(f"leader responded {response.status} for /pkey")
+        try:
+            pkey_data = json.loads(body)
+            RemoteKey.from_ed25519(pkey_data["ed25519"])
+        except (ValueError, KeyError, TypeError, binascii.Error) as err:
+            raise LeaderError(f"invalid key data from leader: {err}") from err
+        return pkey_data
+
+    def trust(self, pkey_data: dict):
+        """Ensure records signed by the given key data can be accepted."""
+        ed25519 = pkey_data.get("ed25519")
+        if ed25519 in self.trusted and self.trusted[ed25519] == pkey_data:
+            return
+        if not self.allow_rotation:
+            raise ReplicationError(f"record signed by untrusted key: {ed25519}")
+        if self.leader_pkey() != pkey_data:
+            raise ReplicationError(
+                f"record signed by key the leader does not report: {ed25519}"
+            )
+        logger.warning("leader key rotated from %s to %s", list(self.trusted), ed25519)
+        self.trusted[ed25519] = pkey_data
+
+    def ingest(self, segment: str, chunk: bytes) -> list:
+        """Verify and append records received from the leader.
+
+        The chunk is only appended if every record in it is verified so
+        that the local archive remains identical to the leader's.
+        Returns the records ingested.
+        """
+        path = segment_path(segment)
+        records, skipped = parse_records(chunk)
+        if skipped:
+            logger.warning("skipped %s torn lines in segment: %s", skipped, segment)
+        for signed, pkey_data in records:
+            self.trust(pkey_data)
+            verify_record(signed, pkey_data)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "ab") as archive_file:
+            archive_file.write(chunk)
+        return records
+
+    def pull(self, segment: str, size: int) -> tuple:
+        """Pull a batch of records for a segment from the leader.
+
+        Returns whether the leader has further records available and
+        the records ingested.
+        """
+        path = segment_path(segment)
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        if offset > size:
+            raise ReplicationError(
+                f"local copy ({offset} bytes) is larger than the leader's ({size})"
+            )
+        response, chunk = self.get(
+            f"/replicate/{quote(segment)}?offset={offset}&limit={self.batch_size}"
+        )
+        if response.status == 404:
+            return False, []
+        if response.status != 200:
+            raise LeaderError(f"leader responded {response.status} for {segment}")
+        try:
+            next_offset = int(response.getheader("X-NEXT-OFFSET"))
+            size = int(response.getheader("X-SEGMENT-SIZE"))
+        except (TypeError, ValueError) as err:
+            raise LeaderError("leader sent an invalid cursor") from err
+        if next_offset != offset + len(chunk):
+            raise LeaderError("leader cursor does not match the data sent")
+        if not chunk:
+            # No whole record is available yet, e.g. a partial write.
+            return False, []
+        records = self.ingest(segment, chunk)
+        logger.info("replicated %s records from segment: %s", len(records), segment)
+        return next_offset < size, records
+
+    def list_segments(self) -> tuple:
+        """Return the leader's node id and its segments and their sizes
+        in chronological order.
+        """
+        response, body = self.get("/replicate")
+        if response.status != 200:
+            raise LeaderError(f"leader responded {response.status} for listing")
+        try:
+            segments = [
+                (item["segment"], int(item["size"])) for item in json.loads(body)
+            ]
+            segments.sort(key=lambda item: segment_order(item[0]))
+        except (ValueError, KeyError, TypeError) as err:
+            raise LeaderError(f"invalid segment listing: {err}") from err
+        return response.getheader("X-NODE-ID"), segments
+
+    def sync(self) -> tuple:
+        """Replicate new records from each of the leader's segments.
+
+        Segments that fail verification are reported and skipped until
+        the stall expires. LeaderError is raised for the caller to retry
+        unless records were already ingested in this pass. Returns
+        whether more records are pending, the records ingested per
+        segment, and the leader's node id.
+        """
+        if not self.trusted:
+            pkey_data = self.leader_pkey()
+            self.trusted[pkey_data["ed25519"]] = pkey_data
+            logger.warning("trusting leader key on first use: %s", pkey_data["ed25519"])
+        node_id, segments = self.list_segments()
+        self.heads = {segment_file_name(segment): segment for segment, _ in segments}
+        pending = False
+        updates = []
+        for segment, size in segments:
+            stalled = self.stalled.get(segment)
+            if stalled:
+                if time.time() - stalled["since"] < self.stall_expiry:
+                    continue
+                logger.info("retrying stalled segment: %s", segment)
+                del self.stalled[segment]
+            try:
+                path = segment_path(segment)
+                if os.path.exists(path) and os.path.getsize(path) == size:
+                    continue
+                more, records = self.pull(segment, size)
+            except ReplicationError as err:
+                self.stalled[segment] = {"reason": f"{err}", "since": int(time.time())}
+                logger.error("replication of segment %s halted: %s", segment, err)
+                continue
+            except LeaderError as err:
+                if not updates:
+                    raise
+                # Serve what was replicated, the next pass retries.
+                logger.warning("replication from leader interrupted: %s", err)
+                return False, updates, node_id
+            if records:
+                updates.append((segment, records))
+            pending = pending or more
+        return pending, updates, node_id
+
+    def halted(self, file_name: str) -> bool:
+        """Return True if the latest segment of a feed file is stalled."""
+        return self.heads.get(file_name) in self.stalled
+
+    def status(self) -> dict:
+        """Return the trusted leader keys and the stalled segments."""
+        return {"trusted": list(self.trusted), "stalled": dict(self.stalled)}
+
+    def restore(self) -> list:
+        """Trust the keys of, and return, the most recent record of each
+        segment in the local archive. These were verified on ingest.
+        """
+        segments = sorted(
+            (
+                os.path.relpath(path, helpers.archive)
+                for path in Path(helpers.archive).glob("*/*.jsonl")
+            ),
+            key=segment_order,
+        )
+        updates = []
+        for segment in segments:
+            lines = helpers.read_lines_reversed(os.path.join(helpers.archive, segment))
+            try:
+                pkey_data = json.loads(next(lines))
+                signed = json.loads(next(lines))
+                verify_record(signed, pkey_data)
+            except (StopIteration, ValueError, ReplicationError):
+                logger.warning("unable to restore from segment: %s", segment)
+                continue
+            self.trusted.setdefault(pkey_data["ed25519"], pkey_data)
+            updates.append((segment, [(signed, pkey_data)]))
+        logger.info("restored %s segments from local archive", len(updates))
+        return updates
+
+    def update(self, file_name: str, signed: dict, pkey_data: dict):
+        """Update the data served for a feed file."""
+        self.latest[file_name] = signed
+        if file_name == helpers.data_feed_file_one:
+            self.feed = signed["data"]["feed_id"]
+        else:
+            self.feed_epoch = signed["data"]["feed_id"]
+        if pkey_data != self.keypair.data:
+            self.keypair = RemoteKey(pkey_data)
+            self.publish_keys()
+        self.publish(file_name, json.dumps(signed, indent=2).encode())
+
+    def apply(self, updates: list, node_id: str = None):
+        """Apply replicated records to the served state.
+
+        Must be called from the event loop.
+        """
+        if node_id:
+            self.uuid = node_id
+        for segment, records in updates:
+            for signed, _ in records:
+                self.remember(signed)
+            file_name = segment_file_name(segment)
+            if file_name in feed_files:
+                self.update(file_name, *records[-1])
+            self.epoch_year = max(self.epoch_year, int(Path(segment).parent.name))
+        if updates:
+            self.write_archive_html()
+
+    async def run_main(self):
+        self.apply(await asyncio.to_thread(self.restore))
+        logger.info("following leader: %s", self.leader.geturl())
+        backoff = self.follow_interval
+        while True:
+            try:
+                pending, updates, node_id = await asyncio.to_thread(self.sync)
+                self.apply(updates, node_id)
+            except Exception as err:  # pylint: disable=broad-except
+                logger.exception(
+                    "replication from leader failed, retrying in %ss: %s",
+                    backoff,
+                    err,
+                )
+                self.disconnect()
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.retry_max)
+                continue
+            backoff = self.follow_interval
+            if not pending:
+                await asyncio.sleep(self.follow_interval)
@@ -2,15 +2,20 @@
 
 import asyncio
 import binascii
+import gzip
+import hashlib
 import json
 import logging
 import os
 import random
 import statistics
+import tempfile
 import time
 import uuid
 
-from datetime import datetime, timezone
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from email.utils import formatdate
 from pathlib import Path
 from typing import Any, Final
 
@@ -36,9 +41,157 @@ index_html: Final[str] = "index.html"
 archive_html: Final[str] = "archive.html"
 data_feed_file_one: Final[str] = "datafeed_one.json"
 data_feed_file_two: Final[str] = "datafeed_two.json"
+archive_replace: Final[str] = "{{!!ARCHIVE-LIST!!}}"
+# Every key data line in the archive starts with this prefix.
+archive_key_prefix: Final[bytes] = b'{"ed25519"'
 UTC_TIME_FORMAT: Final[str] = "%Y-%m-%dT%H:%M:%SZ"
 
 
+def read_records(path: str, offset: int, limit: int) -> bytes:
+    """Read whole archive records from a segment.
+
+    Reads at most `limit` bytes from `offset`, trimmed to the end of
+    the last complete key data line. Each record is two lines, the
+    signed data and the key data, so an empty result is returned when
+    no complete record fits within `limit`.
+    """
+    with open(path, "rb") as reader:
+        reader.seek(offset)
+        chunk = reader.read(limit)
+    end = len(chunk)
+    while True:
+        end = chunk.rfind(b"\n", 0, end)
+        if end < 0:
+            return b""
+        start = chunk.rfind(b"\n", 0, end) + 1
+        if chunk.startswith(archive_key_prefix, start):
+            return chunk[: end + 1]
+
+
+def list_segments() -> list:
+    """Return the archive segments and their sizes, relative to the
+    archive directory.
+    """
+    return [
+        {"segment": path.relative_to(archive).as_posix(), "size": path.stat().st_size}
+        for path in sorted(Path(archive).glob("*/*.jsonl"))
+    ]
+
+
+def write_atomic(path: str, data: bytes):
+    """Write data to path via a temporary file and rename.
+
+    Readers of path will see either the previous or the new contents,
+    never a partially written file.
+    """
+    directory, name = os.path.split(path)
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+    with tempfile.NamedTemporaryFile(
+        dir=directory or ".", prefix=f".{name}.", delete=False
+    ) as tmp:
+        tmp.write(data)
+        tmp.flush()
+        os.fchmod(tmp.fileno(), mode)
+        os.fsync(tmp.fileno())
+    os.replace(tmp.name, path)
+
+
+def read_lines_reversed(path: str, block_size: int = 8192):
+    """Yield the lines of a file from last to first.
+
+    The file is read in blocks seeking backwards from the end so that
+    only the tail needed by the caller is ever read from disk.
+    """
+    with open(path, "rb") as reader:
+        reader.seek(0, os.SEEK_END)
+        position = reader.tell()
+        remainder = b""
+        while position > 0:
+            step = min(block_size, position)
+            position -= step
+            reader.seek(position)
+            block = reader.read(step) + remainder
+            lines = block.split(b"\n")
+            # The first line may be incomplete, hold it for the next block.
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line.decode()
+        if remainder:
+            yield remainder.decode()
+
+
+def segment_name(file_name: str, date: datetime = None) -> str:
+    """Return the archive segment for a feed file relative to the
+    archive directory, e.g. `<epoch_year>/<epoch_day>-datafeed_one.jsonl`.
+
+    Defaults to the segment for the current UTC day.
+    """
+    if date is None:
+        date = datetime.now(timezone.utc)
+    epoch_year = BackgroundRunner.get_granular_timestamp(date.year)
+    epoch_day = BackgroundRunner.get_granular_timestamp(date.year, date.month, date.day)
+    return f"{epoch_year}/{epoch_day}-{file_name}".replace("json", "jsonl")
+
+
+class StaticDocument:
+    """In-memory static document with a precompressed gzip variant."""
+
+    __slots__ = ("body", "body_gzip", "etag", "etag_gzip", "modified")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.body_gzip = gzip.compress(body, mtime=0)
+        digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.etag = f'"{digest}"'
+        self.etag_gzip = f'"{digest}-gzip"'
+        self.modified = int(time.time())
+
+    @property
+    def last_modified(self) -> str:
+        """Return the modified time as an HTTP date."""
+        return formatdate(self.modified, usegmt=True)
+
+
+class Snapshot:
+    """Compact record of a signed observation.
+
+    The signed payload (the JSON document before it was hexlified) and
+    the signature are held as raw bytes rather than hex strings.
+    """
+
+    __slots__ = ("time", "payload", "signature")
+
+    def __init__(self, time_ms: int, payload: bytes, signature: bytes):
+        self.time = time_ms
+        self.payload = payload
+        self.signature = signature
+
+    @classmethod
+    def from_signed(cls, signed: dict):
+        """Create a snapshot from a signed data structure."""
+        return cls(
+            signed["data"]["time"],
+            binascii.unhexlify(signed["payload"]),
+            binascii.unhexlify(signed["signature"]),
+        )
+
+    def to_json(self) -> bytes:
+        """Encode the snapshot as JSON.
+
+        The payload is already JSON so it is embedded as-is.
+        """
+        return b'{"time":%d,"data":%s,"payload":"%s","signature":"%s"}' % (
+            self.time,
+            self.payload,
+            binascii.hexlify(self.payload),
+            binascii.hexlify(self.signature),
+        )
+
+
 class KeyPair:
     """KeyPair for signing data."""
 
@@ -102,23 +255,44 @@ class BackgroundRunner:
 
     max: Final[int] = 120
     seconds: Final[int] = 30
+    recovery_budget: Final[float] = 5.0
+    recent_max: Final[int] = 120
 
     data_feed: Final[int] = f"custom/FEED/{nanoid.generate(size=6)}"
     epoch_feed: Final[int] = f"custom/FEED/epoch1"
 
-    def __init__(self):
+    def __init__(self, keypair: KeyPair = None, on_archive=None):
         self.values = []
         self.value = 0
-        self.keypair = KeyPair()
+        self.keypair = KeyPair() if keypair is None else keypair
+        # Called with the segment, data, and byte offset of each record
+        # written to the archive, e.g. `columnar.append_record`.
+        self.on_archive = on_archive
         self.uuid = f"{uuid.uuid4()}"
         self.feed = self.data_feed
         self.feed_epoch = self.epoch_feed
         self.epoch_year = 0
         self.epoch_day = 0
-        with open(os.path.join(static, keyfile), "w", encoding="utf-8") as pkey:
-            pkey.write(json.dumps(self.keypair.pkey_as_data(), indent=2))
-        with open(os.path.join(static, index_html), "w", encoding="utf-8") as index:
-            index.write(html_helper.page)
+        self.documents = {}
+        self.recent = {}
+        self.publish_keys()
+        self.publish(index_html, html_helper.page.encode())
+
+    def publish_keys(self):
+        """Publish the public key document."""
+        self.publish(
+            keyfile, json.dumps(self.keypair.pkey_as_data(), indent=2).encode()
+        )
+
+    def publish(self, file_name: str, body: bytes):
+        """Publish a static document.
+
+        The document is held in memory alongside a gzip variant and
+        swapped in with a single assignment so that readers never see
+        a partial document. The copy on disk is for persistence only.
+        """
+        self.documents[file_name] = StaticDocument(body)
+        write_atomic(os.path.join(static, file_name), body)
 
     def ls_data_files(self) -> str:
         """List files in the data directory"""
@@ -153,40 +327,131 @@ class BackgroundRunner:
         epoch_day = self.get_granular_timestamp(date.year, date.month, date.day)
         if self.epoch_day != epoch_day:
             self.epoch_day = epoch_day
-        current_fname = f"{self.epoch_day}-{filename}".replace("json", "jsonl")
-        with open(
-            os.path.join(archive, f"{epoch_year}", current_fname), "a"
-        ) as archive_file:
+        segment = os.path.join(archive, segment_name(filename, date))
+        offset = os.path.getsize(segment) if os.path.exists(segment) else 0
+        with open(segment, "a") as archive_file:
             # write key data.
             archive_file.write(json.dumps(data))
             archive_file.write("\n")
             # write data.
             archive_file.write(json.dumps(self.keypair.pkey_as_data()))
             archive_file.write("\n")
-        archive_replace: Final[str] = "{{!!ARCHIVE-LIST!!}}"
+        if self.on_archive is not None:
+            self.on_archive(segment, data["data"], offset)
+        self.write_archive_html()
+
+    def remember(self, signed: dict):
+        """Add a signed data structure to its feed's recent snapshots."""
+        feed_id = signed["data"]["feed_id"]
+        if feed_id not in self.recent:
+            self.recent[feed_id] = deque(maxlen=self.recent_max)
+        self.recent[feed_id].append(Snapshot.from_signed(signed))
+
+    def recent_json(self, feed_id: str, count: int) -> bytes:
+        """Return the most recent snapshots for a feed as JSON, newest
+        first.
+        """
+        ring = self.recent[feed_id]
+        count = min(count, len(ring))
+        snapshots = (ring[-idx].to_json() for idx in range(1, count + 1))
+        return b"[" + b",".join(snapshots) + b"]"
+
+    def write_archive_html(self):
+        """Write the archive catalog for the current epoch year."""
         with open(os.path.join(archive, archive_html), "w") as html:
             li = self.ls_data_files()
             page = html_helper.archive.replace(archive_replace, li)
             html.write(page)
 
+    def recover(self, budget: float = None) -> int:
+        """Restore the rolling window and archive state after a restart.
+
+        The tail of the current day's archive segment is read backwards
+        to refill `values` with observations from the past hour, followed
+        by the tail of the previous day's segment if the window starts
+        before midnight. Every archive record is two lines, the signed
+        data followed by the key data, so only the data lines are
+        considered.
+
+        Recovery stops when the window is full, when records fall
+        outside the window, or when `budget` seconds have elapsed.
+        Returns the number of records recovered.
+        """
+        if budget is None:
+            budget = self.recovery_budget
+        deadline = time.monotonic() + budget
+        date = datetime.now(timezone.utc)
+        earliest = (int(time.time()) - self.max * self.seconds) * 1000
+        dates = [date]
+        epoch_day = self.get_granular_timestamp(date.year, date.month, date.day)
+        if earliest < epoch_day * 1000:
+            dates.append(date - timedelta(days=1))
+        segments = [
+            (day, os.path.join(archive, segment_name(data_feed_file_one, day)))
+            for day in dates
+        ]
+        segments = [(day, path) for day, path in segments if os.path.exists(path)]
+        if not segments:
+            logger.info("no archive segment to recover from")
+            return 0
+        day = segments[0][0]
+        self.epoch_year = self.get_granular_timestamp(day.year)
+        self.epoch_day = self.get_granular_timestamp(day.year, day.month, day.day)
+        recovered = []
+        for _, segment in segments:
+            for line in read_lines_reversed(segment):
+                if time.monotonic() > deadline:
+                    logger.warning("recovery budget of %ss exhausted", budget)
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning("skipping unreadable archive line")
+                    continue
+                data = record.get("data")
+                if not isinstance(data, dict) or "current" not in data:
+                    # Key data.
+                    continue
+                if data.get("time", 0) < earliest:
+                    break
+                recovered.append(data["current"])
+                if len(recovered) > self.max:
+                    break
+            else:
+                continue
+            break
+        recovered.reverse()
+        if recovered:
+            self.values = recovered
+            self.value = recovered[-1]
+        self.write_archive_html()
+        logger.info(
+            "recovered %s records from archive segments: %s",
+            len(recovered),
+            [segment for _, segment in segments],
+        )
+        return len(recovered)
+
     async def write_feed_data(self, data: dict, file_name: str):
         """Write feed data."""
-        with open(os.path.join(static, file_name), "w", encoding="utf-8") as datafeed:
-            datafeed.write(json.dumps(data, indent=2))
+        self.publish(file_name, json.dumps(data, indent=2).encode())
         self.write_indices(data, file_name)
 
     async def run_main(self):
+        await asyncio.to_thread(self.recover)
         while True:
             self.value = random.randrange(-3, 41)
             if len(self.values) > self.max:
                 self.values.pop(0)
             self.values.append(self.value)
             feed_one = self.valuedata
+            self.remember(feed_one)
             await self.write_feed_data(
                 feed_one,
                 data_feed_file_one,
             )
             feed_two = self.pluraldata
+            self.remember(feed_two)
             await self.write_feed_data(feed_two, data_feed_file_two)
             await asyncio.sleep(self.seconds)
 
@@ -4,10 +4,13 @@ import asyncio
 import argparse
 import binascii
 import logging
+import os
 import time
 import importlib
 
 from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from pathlib import Path
 from typing import Final
 
 import cbor2
@@ -17,12 +20,14 @@ from cryptography import exceptions
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
 from cryptography.hazmat.primitives import serialization
 
-from fastapi import FastAPI, Header, Response
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.responses import RedirectResponse
 from fastapi.staticfiles import StaticFiles
 
 
+import columnar
 import config
+import follower
 import helpers
 
 # Set up logging.
@@ -45,6 +50,7 @@ logger = logging.getLogger(config.UVICORN_LOGGER)
 TAG_DATA: Final[str] = "data"
 TAG_DEBUG: Final[str] = "debug"
 TAG_UTILITY: Final[str] = "utility"
+TAG_REPLICATION: Final[str] = "replication"
 
 
 @asynccontextmanager
@@ -53,8 +59,26 @@ async def lifespan(app: FastAPI):
     yield
 
 
+def get_runner() -> helpers.BackgroundRunner:
+    """Return a follower if a leader is configured, else a leader."""
+    leader = os.environ.get(config.LEADER_ENV, "")
+    if leader:
+        pkeys = os.environ.get(config.LEADER_PKEY_ENV, "")
+        return follower.FollowerRunner(
+            leader,
+            pkeys=[pkey.strip() for pkey in pkeys.split(",") if pkey.strip()],
+            allow_rotation=bool(os.environ.get(config.ALLOW_KEY_ROTATION_ENV)),
+        )
+    if config.COLUMNAR_SIDECAR:
+        return helpers.BackgroundRunner(on_archive=columnar.append_record)
+    return helpers.BackgroundRunner()
+
+
 app = FastAPI(lifespan=lifespan)
-runner = helpers.BackgroundRunner()
+
+# When run as a script uvicorn imports `main:app` again once `main()` has
+# applied the arguments to the environment, so no runner is needed here.
+runner = get_runner() if __name__ != "__main__" else None
 
 
 def all_headers(response: Response, feed_id: str = "") -> Response:
@@ -67,9 +91,18 @@ def all_headers(response: Response, feed_id: str = "") -> Response:
     return response
 
 
+def replication_halted(file_name: str):
+    """Raise service unavailable rather than serve stale data when a
+    follower can no longer replicate a feed file.
+    """
+    if isinstance(runner, follower.FollowerRunner) and runner.halted(file_name):
+        raise HTTPException(status_code=503, detail="replication from leader halted")
+
+
 @app.head("/data", include_in_schema=False)
 @app.get("/data", tags=[TAG_DATA])
 async def data(response: Response):
+    replication_halted(helpers.data_feed_file_one)
     all_headers(response, runner.feed)
     return runner.valuedata
 
@@ -77,6 +110,7 @@ async def data(response: Response):
 @app.head("/data_debug", include_in_schema=False)
 @app.get("/data_debug", tags=[TAG_DEBUG])
 async def data(response: Response):
+    replication_halted(helpers.data_feed_file_one)
     all_headers(response, runner.feed)
     return runner.valuedata_debug
 
@@ -84,10 +118,68 @@ async def data(response: Response):
 @app.head("/data_plural", include_in_schema=False)
 @app.get("/data_plural", tags=[TAG_DATA])
 async def data(response: Response):
+    replication_halted(helpers.data_feed_file_two)
     all_headers(response, runner.feed_epoch)
     return runner.pluraldata
 
 
+@app.head("/feeds/{feed_id:path}/recent", include_in_schema=False)
+@app.get("/feeds/{feed_id:path}/recent", tags=[TAG_DATA])
+async def recent(
+    feed_id: str,
+    n: int = Query(default=10, ge=1, le=helpers.BackgroundRunner.recent_max),
+):
+    if feed_id not in runner.recent:
+        raise HTTPException(status_code=404, detail="Not Found")
+    response = Response(
+        content=runner.recent_json(feed_id, n), media_type="application/json"
+    )
+    return all_headers(response, feed_id)
+
+
+@app.get("/replicate", tags=[TAG_REPLICATION])
+def replicate_segments(response: Response):
+    """Return the archive segments available to replicate and their
+    sizes.
+    """
+    all_headers(response)
+    return helpers.list_segments()
+
+
+@app.get("/replicate/status", tags=[TAG_REPLICATION])
+async def replication_status(response: Response):
+    """Return the leader keys a follower trusts and the segments it has
+    stalled on.
+    """
+    if not isinstance(runner, follower.FollowerRunner):
+        raise HTTPException(status_code=404, detail="Not Found")
+    all_headers(response)
+    return runner.status()
+
+
+@app.get("/replicate/{segment:path}", tags=[TAG_REPLICATION])
+def replicate(
+    segment: str,
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=1024 * 1024, ge=4096, le=16 * 1024 * 1024),
+):
+    """Return whole archive records from `offset` in an archive segment.
+
+    `X-NEXT-OFFSET` is the cursor for the next request and
+    `X-SEGMENT-SIZE` the current size of the segment.
+    """
+    base = Path(helpers.archive).resolve()
+    path = (base / segment).resolve()
+    if not path.is_relative_to(base) or not path.is_file():
+        raise HTTPException(status_code=404, detail="Not Found")
+    size = path.stat().st_size
+    chunk = helpers.read_records(str(path), offset, limit) if offset < size else b""
+    response = Response(content=chunk, media_type="application/octet-stream")
+    response.headers["X-NEXT-OFFSET"] = f"{offset + len(chunk)}"
+    response.headers["X-SEGMENT-SIZE"] = f"{size}"
+    return all_headers(response)
+
+
 @app.head("/pkey", include_in_schema=False)
 @app.get("/pkey", tags=[TAG_DATA])
 async def key(response: Response):
@@ -163,6 +255,92 @@ async def verify_signature(
     }
 
 
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Return True if gzip is acceptable according to the q-values of
+    an Accept-Encoding header.
+    """
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() != "q":
+                continue
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        qualities[coding.lower()] = quality
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
+def not_modified(headers, etag: str, modified: int) -> bool:
+    """Return True if a conditional request matches the document."""
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return modified <= since
+    return False
+
+
+def static_document(file_name: str, media_type: str, request: Request):
+    """Return an in-memory static document, compressed where accepted,
+    honouring conditional requests.
+    """
+    try:
+        document = runner.documents[file_name]
+    except KeyError as err:
+        raise HTTPException(status_code=404, detail="Not Found") from err
+    body, etag = document.body, document.etag
+    headers = {"Vary": "Accept-Encoding", "Last-Modified": document.last_modified}
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        headers["Content-Encoding"] = "gzip"
+        body, etag = document.body_gzip, document.etag_gzip
+    headers["ETag"] = etag
+    if not_modified(request.headers, etag, document.modified):
+        headers.pop("Content-Encoding", None)
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+@app.head("/", include_in_schema=False)
+@app.get("/", include_in_schema=False)
+@app.head(f"/{helpers.index_html}", include_in_schema=False)
+@app.get(f"/{helpers.index_html}", include_in_schema=False)
+async def index(request: Request):
+    return static_document(helpers.index_html, "text/html", request)
+
+
+@app.head(f"/{helpers.keyfile}", include_in_schema=False)
+@app.get(f"/{helpers.keyfile}", include_in_schema=False)
+async def keyfile(request: Request):
+    return static_document(helpers.keyfile, "application/json", request)
+
+
+@app.head(f"/{helpers.data_feed_file_one}", include_in_schema=False)
+@app.get(f"/{helpers.data_feed_file_one}", include_in_schema=False)
+async def datafeed_one(request: Request):
+    replication_halted(helpers.data_feed_file_one)
+    return static_document(helpers.data_feed_file_one, "application/json", request)
+
+
+@app.head(f"/{helpers.data_feed_file_two}", include_in_schema=False)
+@app.get(f"/{helpers.data_feed_file_two}", include_in_schema=False)
+async def datafeed_two(request: Request):
+    replication_halted(helpers.data_feed_file_two)
+    return static_document(helpers.data_feed_file_two, "application/json", request)
+
+
 # Must be defined after all the other routes.
 #
 # Ref: https://stackoverflow.com/a/73916745/23789970
@@ -195,6 +373,28 @@ def main():
         action="store_true",
     )
 
+    parser.add_argument(
+        "--leader",
+        help="follow the archive of a leader node, e.g. http://127.0.0.1:8001",
+        required=False,
+        default="",
+    )
+
+    parser.add_argument(
+        "--leader-pkey",
+        help="comma separated ed25519 public keys (hex) trusted for the leader, defaults to the leader's /pkey on first use",
+        required=False,
+        default="",
+    )
+
+    parser.add_argument(
+        "--allow-key-rotation",
+        help="accept a new leader key if the leader reports it via /pkey",
+        required=False,
+        default=False,
+        action="store_true",
+    )
+
     parser.add_argument(
         "--workers",
         help="enable more workers",
@@ -205,6 +405,13 @@ def main():
 
     args = parser.parse_args()
 
+    if args.leader:
+        os.environ[config.LEADER_ENV] = args.leader
+    if args.leader_pkey:
+        os.environ[config.LEADER_PKEY_ENV] = args.leader_pkey
+    if args.allow_key_rotation:
+        os.environ[config.ALLOW_KEY_ROTATION_ENV] = "1"
+
     logger.info(
         "attempting API startup, try setting `--port` arg if there are any issues"
     )
@@ -0,0 +1,14 @@
+"""Shared fixtures."""
+
+import pytest
+
+import helpers
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run from a temporary directory with the expected layout."""
+    (tmp_path / helpers.static).mkdir()
+    (tmp_path / helpers.archive).mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
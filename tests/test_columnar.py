@@ -0,0 +1,118 @@
+"""Ensure archive segments export to columnar files."""
+
+import json
+import math
+import os
+
+import pytest
+
+import columnar
+import helpers
+
+
+def test_export_segment(workdir):
+    """Ensure exported columns match the archive and locate signatures."""
+    runner = helpers.BackgroundRunner()
+    signed = []
+    for value in (3, 7, 11):
+        runner.value = value
+        runner.values.append(value)
+        signed.append(runner.valuedata)
+        runner.write_indices(signed[-1], helpers.data_feed_file_one)
+    segment = os.path.join(
+        helpers.archive, helpers.segment_name(helpers.data_feed_file_one)
+    )
+    assert columnar.export_segment(segment) == 3
+    with columnar.ColumnarSegment(columnar.segment_dir(segment)) as exported:
+        assert len(exported) == 3
+        assert exported.columns["time"].tolist() == [
+            item["data"]["time"] for item in signed
+        ]
+        assert exported.columns["current"].tolist() == [3, 7, 11]
+        assert exported.columns["average"].tolist() == [3, 5, 7]
+        with open(segment, "rb") as reader:
+            for offset, expected in zip(exported.columns["offset"], signed):
+                reader.seek(offset)
+                record = json.loads(reader.readline())
+                assert record["signature"] == expected["signature"]
+
+
+def test_sidecar(workdir):
+    """Ensure the write-time sidecar matches an export."""
+    runner = helpers.BackgroundRunner(on_archive=columnar.append_record)
+    for _ in range(2):
+        runner.write_indices(runner.pluraldata, helpers.data_feed_file_two)
+    segment = os.path.join(
+        helpers.archive, helpers.segment_name(helpers.data_feed_file_two)
+    )
+    directory = columnar.segment_dir(segment)
+    with columnar.ColumnarSegment(directory) as sidecar:
+        assert len(sidecar) == 2
+        assert all(math.isnan(value) for value in sidecar.columns["average"])
+        rows = {name: view.tolist() for name, view in sidecar.columns.items()}
+    exported = os.path.join(workdir, "exported")
+    columnar.export_segment(segment, exported)
+    with columnar.ColumnarSegment(exported) as export:
+        assert export.columns["time"].tolist() == rows["time"]
+        assert export.columns["current"].tolist() == rows["current"]
+        assert export.columns["offset"].tolist() == rows["offset"]
+
+
+def test_export_empty(workdir):
+    """Ensure empty segments can be exported and read."""
+    segment = os.path.join(helpers.archive, "empty.jsonl")
+    open(segment, "w", encoding="utf-8").close()
+    assert columnar.export_segment(segment) == 0
+    with columnar.ColumnarSegment(columnar.segment_dir(segment)) as exported:
+        assert len(exported) == 0
+
+
+def test_sidecar_backfill(workdir):
+    """Ensure a sidecar enabled partway through a segment is backfilled
+    and a sidecar left inconsistent by a crash is rebuilt.
+    """
+    runner = helpers.BackgroundRunner()
+    runner.write_indices(runner.valuedata, helpers.data_feed_file_one)
+    runner.on_archive = columnar.append_record
+    runner.write_indices(runner.valuedata, helpers.data_feed_file_one)
+    segment = os.path.join(
+        helpers.archive, helpers.segment_name(helpers.data_feed_file_one)
+    )
+    directory = columnar.segment_dir(segment)
+    with columnar.ColumnarSegment(directory) as sidecar:
+        assert len(sidecar) == 2
+        assert sidecar.columns["offset"][0] == 0
+    # Simulate a crash between column appends.
+    with open(columnar.column_file(directory, "time"), "ab") as column:
+        column.write(bytes(8))
+    with pytest.raises(columnar.ColumnarError):
+        columnar.ColumnarSegment(directory).open()
+    runner.write_indices(runner.valuedata, helpers.data_feed_file_one)
+    with columnar.ColumnarSegment(directory) as sidecar:
+        assert len(sidecar) == 3
+
+
+def test_partial_row(workdir):
+    """Ensure partial rows and missing columns are reported as errors and
+    no column files are left mapped.
+    """
+    runner = helpers.BackgroundRunner()
+    runner.write_indices(runner.valuedata, helpers.data_feed_file_one)
+    segment = os.path.join(
+        helpers.archive, helpers.segment_name(helpers.data_feed_file_one)
+    )
+    columnar.export_segment(segment)
+    directory = columnar.segment_dir(segment)
+    # Simulate a crash partway through writing a row.
+    with open(columnar.column_file(directory, "offset"), "ab") as column:
+        column.write(bytes(3))
+    exported = columnar.ColumnarSegment(directory)
+    with pytest.raises(columnar.ColumnarError):
+        exported.open()
+    assert not exported.columns
+    assert not exported._maps
+    os.remove(columnar.column_file(directory, "offset"))
+    with pytest.raises(columnar.ColumnarError):
+        exported.open()
+    assert not exported.columns
+    assert not exported._maps
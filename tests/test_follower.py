@@ -0,0 +1,396 @@
+"""Ensure followers replicate the archive of a leader."""
+
+import binascii
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException, Response
+
+import follower
+import helpers
+import main
+
+MAIN: Path = Path(main.__file__).resolve()
+
+
+def _record(keypair: helpers.KeyPair, **data) -> bytes:
+    """Return an archive record signed by the given key pair."""
+    signed_hex, data_hex = keypair.sign_data(
+        binascii.hexlify(json.dumps(data).encode())
+    )
+    signed = {
+        "data": data,
+        "description": "",
+        "payload": data_hex,
+        "signature": signed_hex,
+    }
+    return f"{json.dumps(signed)}\n{json.dumps(keypair.pkey_as_data())}\n".encode()
+
+
+def test_read_records(tmp_path):
+    """Ensure only whole records are returned."""
+    keypair = helpers.KeyPair()
+    records = [
+        _record(keypair, feed_id="feed", time=idx, current=idx) for idx in range(2)
+    ]
+    path = tmp_path / "segment.jsonl"
+    path.write_bytes(b"".join(records) + records[0][:-20])
+    assert helpers.read_records(str(path), 0, 4096) == b"".join(records)
+    assert helpers.read_records(str(path), 0, len(records[0]) + 5) == records[0]
+    assert helpers.read_records(str(path), len(records[0]), 4096) == records[1]
+    assert helpers.read_records(str(path), 0, 5) == b""
+
+
+def test_parse_records():
+    """Ensure pairing resynchronises after a torn write."""
+    keypair = helpers.KeyPair()
+    first, second, third = (
+        _record(keypair, feed_id="feed", time=idx, current=idx) for idx in range(3)
+    )
+    # A crash left the key data of the first record partially written.
+    torn = first[: first.index(b"\n") + 10] + second + third
+    records, skipped = follower.parse_records(torn)
+    assert [signed["data"]["time"] for signed, _ in records] == [2]
+    assert skipped == 3
+    records, skipped = follower.parse_records(first + second)
+    assert len(records) == 2
+    assert skipped == 0
+    # Valid lines must be paired unless next to a torn line.
+    with pytest.raises(follower.ReplicationError):
+        follower.parse_records(first + first.split(b"\n")[0] + b"\n" + second)
+
+
+def test_verify_record():
+    """Ensure records are verified against their key data."""
+    signed = main.runner.valuedata
+    pkey_data = main.runner.keypair.pkey_as_data()
+    follower.verify_record(signed, pkey_data)
+    tampered = dict(signed, data=dict(signed["data"], current=1000))
+    with pytest.raises(follower.ReplicationError):
+        follower.verify_record(tampered, pkey_data)
+    other = helpers.KeyPair().pkey_as_data()
+    with pytest.raises(follower.ReplicationError):
+        follower.verify_record(signed, other)
+
+
+def test_follower_leader_url(workdir):
+    """Ensure only http(s) leaders are accepted."""
+    with pytest.raises(ValueError):
+        follower.FollowerRunner("ftp://127.0.0.1:8001")
+    runner = follower.FollowerRunner("https://leader.example")
+    assert runner.leader.scheme == "https"
+
+
+def test_ingest_untrusted_key(workdir):
+    """Ensure records signed by keys other than the leader's are rejected
+    and not archived.
+    """
+    leader, other = helpers.KeyPair(), helpers.KeyPair()
+    runner = follower.FollowerRunner(
+        "http://127.0.0.1:8001", pkeys=[leader.pkey_ed25519]
+    )
+    segment = helpers.segment_name(helpers.data_feed_file_one)
+    records = runner.ingest(segment, _record(leader, feed_id="feed", time=1))
+    assert len(records) == 1
+    path = os.path.join(helpers.archive, segment)
+    size = os.path.getsize(path)
+    with pytest.raises(follower.ReplicationError):
+        runner.ingest(segment, _record(other, feed_id="feed", time=2))
+    assert os.path.getsize(path) == size
+
+
+def test_segment_names(workdir, tmp_path):
+    """Ensure segments named by the leader cannot be written outside of
+    the archive.
+    """
+    keypair = helpers.KeyPair()
+    runner = follower.FollowerRunner(
+        "http://127.0.0.1:8001", pkeys=[keypair.pkey_ed25519]
+    )
+    record = _record(keypair, feed_id="feed", time=1)
+    for segment in (
+        "../../escaped/1-datafeed_one.jsonl",
+        "2025/../../1-datafeed_one.jsonl",
+        "/tmp/1-datafeed_one.jsonl",
+        "2025/1-main.py",
+        "2025/1-datafeed_one.jsonl/../../x",
+    ):
+        with pytest.raises(follower.ReplicationError):
+            runner.ingest(segment, record)
+        with pytest.raises(follower.ReplicationError):
+            runner.pull(segment, len(record))
+    assert not (tmp_path.parent / "escaped").exists()
+    assert list(Path(helpers.archive).iterdir()) == []
+    segment = helpers.segment_name(helpers.data_feed_file_one)
+    assert follower.segment_path(segment) == str(
+        Path(helpers.archive, segment).resolve()
+    )
+
+
+def test_key_rotation(workdir, monkeypatch):
+    """Ensure a new key is only accepted when rotation is allowed and the
+    leader reports it.
+    """
+    leader, rotated = helpers.KeyPair(), helpers.KeyPair()
+    runner = follower.FollowerRunner(
+        "http://127.0.0.1:8001", pkeys=[leader.pkey_ed25519], allow_rotation=True
+    )
+    segment = helpers.segment_name(helpers.data_feed_file_one)
+    monkeypatch.setattr(runner, "leader_pkey", leader.pkey_as_data)
+    with pytest.raises(follower.ReplicationError):
+        runner.ingest(segment, _record(rotated, feed_id="feed", time=1))
+    monkeypatch.setattr(runner, "leader_pkey", rotated.pkey_as_data)
+    assert len(runner.ingest(segment, _record(rotated, feed_id="feed", time=1))) == 1
+    assert rotated.pkey_ed25519 in runner.trusted
+
+
+class _Response:
+    """Response from a leader."""
+
+    def __init__(self, status: int, headers: dict = None):
+        self.status = status
+        self.headers = headers or {}
+
+    def getheader(self, name: str):
+        """Return a response header."""
+        return self.headers.get(name)
+
+
+def test_sync_stalled(workdir, monkeypatch):
+    """Ensure unexpected responses are retried while segments failing
+    verification are stalled until the stall expires.
+    """
+    leader, other = helpers.KeyPair(), helpers.KeyPair()
+    runner = follower.FollowerRunner(
+        "http://127.0.0.1:8001", pkeys=[leader.pkey_ed25519]
+    )
+    segment = helpers.segment_name(helpers.data_feed_file_one)
+    record = _record(leader, feed_id="feed", time=1)
+    replies = {}
+
+    def get(path):
+        if path == "/replicate":
+            listing = [{"segment": segment, "size": len(replies["chunk"])}]
+            return _Response(200), json.dumps(listing).encode()
+        chunk = replies["chunk"]
+        headers = {"X-NEXT-OFFSET": f"{len(chunk)}", "X-SEGMENT-SIZE": f"{len(chunk)}"}
+        return _Response(replies["status"], headers), chunk
+
+    monkeypatch.setattr(runner, "get", get)
+    replies.update(status=503, chunk=record)
+    with pytest.raises(follower.LeaderError):
+        runner.sync()
+    assert not runner.stalled
+    replies.update(status=200, chunk=_record(other, feed_id="feed", time=1))
+    assert runner.sync() == (False, [], None)
+    assert "untrusted key" in runner.stalled[segment]["reason"]
+    assert runner.halted(helpers.data_feed_file_one)
+    assert not runner.halted(helpers.data_feed_file_two)
+    replies.update(chunk=record)
+    assert runner.sync() == (False, [], None)
+    runner.stalled[segment]["since"] -= runner.stall_expiry
+    _, updates, _ = runner.sync()
+    assert [len(records) for _, records in updates] == [1]
+    assert not runner.stalled
+    assert not runner.halted(helpers.data_feed_file_one)
+
+
+def test_restore(workdir):
+    """Ensure the latest data and keys are restored from the local
+    archive.
+    """
+    keypair = helpers.KeyPair()
+    segment = helpers.segment_name(helpers.data_feed_file_one)
+    Path(helpers.archive, segment).parent.mkdir(parents=True)
+    Path(helpers.archive, segment).write_bytes(
+        _record(keypair, feed_id="feed", time=1)
+        + _record(keypair, feed_id="feed", time=2)
+    )
+    runner = follower.FollowerRunner("http://127.0.0.1:8001")
+    runner.apply(runner.restore())
+    assert keypair.pkey_ed25519 in runner.trusted
+    assert runner.valuedata["data"]["time"] == 2
+    assert runner.feed == "feed"
+    assert runner.keypair.pkey_as_data() == keypair.pkey_as_data()
+
+
+def test_replicate_segments(workdir):
+    """Ensure segments are listed and files outside of the archive cannot
+    be replicated.
+    """
+    runner = helpers.BackgroundRunner()
+    runner.write_indices(runner.valuedata, helpers.data_feed_file_one)
+    segment = helpers.segment_name(helpers.data_feed_file_one)
+    size = os.path.getsize(os.path.join(helpers.archive, segment))
+    assert main.replicate_segments(Response()) == [{"segment": segment, "size": size}]
+    with pytest.raises(HTTPException) as err:
+        main.replicate("../main.py", offset=0, limit=4096)
+    assert err.value.status_code == 404
+
+
+def _free_port() -> int:
+    """Return a port that is free to bind to."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start(directory: Path, port: int, *args) -> subprocess.Popen:
+    """Start a node in its own working directory."""
+    (directory / helpers.static).mkdir(parents=True, exist_ok=True)
+    (directory / helpers.archive).mkdir(exist_ok=True)
+    return subprocess.Popen(
+        [sys.executable, str(MAIN), "--port", f"{port}", *args],
+        cwd=directory,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def _get(port: int, path: str):
+    """Return the response body and headers for a request to a node."""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}") as res:
+            return res.read(), res.headers
+    except (urllib.error.URLError, ConnectionError):
+        return None, None
+
+
+def _status(port: int, path: str) -> int:
+    """Return the status code of a request to a node."""
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}") as res:
+            return res.status
+    except urllib.error.HTTPError as err:
+        return err.code
+    except (urllib.error.URLError, ConnectionError):
+        return 0
+
+
+def _wait_for(predicate, timeout: int = 30) -> bool:
+    """Wait for a predicate to hold."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.25)
+    return False
+
+
+def test_follower(tmp_path):
+    """Ensure a follower process serves the same data as its leader,
+    including segments written before the follower started.
+    """
+    leader_port, follower_port = _free_port(), _free_port()
+    leader_archive = tmp_path / "leader" / helpers.archive
+    # A segment from a previous day signed by an earlier leader key.
+    previous = helpers.KeyPair()
+    yesterday = datetime.now(timezone.utc) - timedelta(days=1)
+    old_segment = helpers.segment_name(helpers.data_feed_file_one, yesterday)
+    (leader_archive / old_segment).parent.mkdir(parents=True)
+    (leader_archive / old_segment).write_bytes(
+        _record(previous, feed_id="feed", time=1, current=1)
+    )
+    leader = _start(tmp_path / "leader", leader_port)
+    nodes = [leader]
+    try:
+        assert _wait_for(lambda: _get(leader_port, "/datafeed_two.json")[0])
+        pkey = json.loads(_get(leader_port, "/pkey")[0])["ed25519"]
+        nodes.append(
+            _start(
+                tmp_path / "follower",
+                follower_port,
+                "--leader",
+                f"http://127.0.0.1:{leader_port}",
+                "--leader-pkey",
+                f"{previous.pkey_ed25519},{pkey}",
+            )
+        )
+        segments = sorted(
+            path.relative_to(leader_archive).as_posix()
+            for path in leader_archive.glob("*/*.jsonl")
+        )
+        assert len(segments) == 3
+        paths = [f"/archive/{segment}" for segment in segments] + [
+            "/pkey",
+            f"/{helpers.keyfile}",
+            f"/{helpers.data_feed_file_one}",
+            f"/{helpers.data_feed_file_two}",
+        ]
+
+        def replicated():
+            for path in paths:
+                body, _ = _get(follower_port, path)
+                if body is None or body != _get(leader_port, path)[0]:
+                    return False
+            return True
+
+        assert _wait_for(replicated)
+        data, headers = _get(follower_port, "/data")
+        _, leader_headers = _get(leader_port, "/data")
+        assert headers["X-NODE-ID"] == leader_headers["X-NODE-ID"]
+        assert headers["X-FEED-ID"] == leader_headers["X-FEED-ID"]
+        expected, _ = _get(leader_port, f"/{helpers.data_feed_file_one}")
+        assert json.loads(data) == json.loads(expected)
+    finally:
+        for node in nodes:
+            node.terminate()
+            node.wait(timeout=10)
+
+
+def test_follower_leader_restart(tmp_path):
+    """Ensure a follower reports that it has stalled when its leader
+    restarts with a new key, unless key rotation is allowed.
+    """
+    leader_port, pinned_port, rotating_port = (_free_port() for _ in range(3))
+    leader_url = f"http://127.0.0.1:{leader_port}"
+    leader = _start(tmp_path / "leader", leader_port)
+    nodes = [leader]
+    try:
+        assert _wait_for(lambda: _get(leader_port, "/datafeed_two.json")[0])
+        pkey, _ = _get(leader_port, "/pkey")
+        nodes.append(_start(tmp_path / "pinned", pinned_port, "--leader", leader_url))
+        nodes.append(
+            _start(
+                tmp_path / "rotating",
+                rotating_port,
+                "--leader",
+                leader_url,
+                "--allow-key-rotation",
+            )
+        )
+        for port in (pinned_port, rotating_port):
+            assert _wait_for(lambda: _get(port, "/pkey")[0] == pkey)
+            assert _status(port, "/data") == 200
+            assert json.loads(_get(port, "/replicate/status")[0])["stalled"] == {}
+        leader.terminate()
+        leader.wait(timeout=10)
+        leader = _start(tmp_path / "leader", leader_port)
+        nodes.append(leader)
+        assert _wait_for(lambda: _get(leader_port, "/pkey")[0] not in (None, pkey))
+        rotated, _ = _get(leader_port, "/pkey")
+        assert _wait_for(lambda: _status(pinned_port, "/data") == 503, timeout=60)
+        assert _status(pinned_port, "/data_plural") == 503
+        assert _status(pinned_port, f"/{helpers.data_feed_file_one}") == 503
+        status = json.loads(_get(pinned_port, "/replicate/status")[0])
+        assert sorted(status["stalled"]) == sorted(
+            helpers.segment_name(name) for name in follower.feed_files
+        )
+        assert _get(pinned_port, "/pkey")[0] == pkey
+        assert _wait_for(lambda: _get(rotating_port, "/pkey")[0] == rotated, 60)
+        assert _status(rotating_port, "/data") == 200
+        assert json.loads(_get(rotating_port, "/replicate/status")[0])["stalled"] == {}
+    finally:
+        for node in nodes:
+            node.terminate()
+            node.wait(timeout=10)
@@ -0,0 +1,55 @@
+"""Ensure recent snapshots are retained and served."""
+
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import helpers
+import main
+
+
+@pytest.mark.asyncio
+async def test_recent(workdir, monkeypatch):
+    """Ensure recent snapshots are served newest first and verify."""
+    runner = helpers.BackgroundRunner()
+    monkeypatch.setattr(main, "runner", runner)
+    signed = []
+    for value in range(3):
+        runner.value = value
+        signed.append(runner.valuedata)
+        runner.remember(signed[-1])
+    res = await main.recent(runner.feed, n=2)
+    assert res.headers["x-feed-id"] == runner.feed
+    snapshots = json.loads(res.body)
+    assert len(snapshots) == 2
+    assert snapshots[0]["data"] == signed[2]["data"]
+    assert snapshots[1]["data"] == signed[1]["data"]
+    for snapshot, expected in zip(snapshots, reversed(signed)):
+        assert snapshot["time"] == expected["data"]["time"]
+        assert snapshot["payload"] == expected["payload"]
+        assert snapshot["signature"] == expected["signature"]
+        res = await main.verify_signature(
+            runner.keypair.pkey_ed25519, snapshot["signature"], snapshot["payload"]
+        )
+        assert res["valid"] is True
+    res = await main.recent(runner.feed, n=10)
+    assert len(json.loads(res.body)) == 3
+
+
+@pytest.mark.asyncio
+async def test_recent_bounded(workdir):
+    """Ensure the ring does not grow beyond its maximum."""
+    runner = helpers.BackgroundRunner()
+    for _ in range(runner.recent_max + 5):
+        runner.remember(runner.pluraldata)
+    assert len(runner.recent[runner.feed_epoch]) == runner.recent_max
+
+
+@pytest.mark.asyncio
+async def test_recent_unknown_feed(workdir, monkeypatch):
+    """Ensure unknown feeds are not found."""
+    monkeypatch.setattr(main, "runner", helpers.BackgroundRunner())
+    with pytest.raises(HTTPException) as err:
+        await main.recent("custom/FEED/unknown", n=1)
+    assert err.value.status_code == 404
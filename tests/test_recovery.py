@@ -0,0 +1,94 @@
+"""Ensure state is recovered from the archive on restart."""
+
+import json
+import os
+import time
+
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import helpers
+
+
+def test_read_lines_reversed(tmp_path):
+    """Ensure lines are returned last to first across block boundaries."""
+    path = tmp_path / "lines.jsonl"
+    lines = [json.dumps({"line": idx, "pad": "x" * idx}) for idx in range(50)]
+    path.write_text("\n".join(lines) + "\n")
+    res = list(helpers.read_lines_reversed(str(path), block_size=16))
+    assert res == list(reversed(lines))
+
+
+def test_recover(workdir):
+    """Ensure the rolling window and archive catalog are restored."""
+    runner = helpers.BackgroundRunner()
+    for value in (1, 2, 3, 4):
+        runner.value = value
+        runner.values.append(value)
+        runner.write_indices(runner.valuedata, helpers.data_feed_file_one)
+        runner.write_indices(runner.pluraldata, helpers.data_feed_file_two)
+    os.remove(os.path.join(helpers.archive, helpers.archive_html))
+
+    restarted = helpers.BackgroundRunner()
+    assert restarted.recover() == 4
+    assert restarted.values == [1, 2, 3, 4]
+    assert restarted.value == 4
+    assert restarted.epoch_year == runner.epoch_year
+    assert restarted.epoch_day == runner.epoch_day
+    assert os.path.exists(os.path.join(helpers.archive, helpers.archive_html))
+
+
+def test_recover_window(workdir):
+    """Ensure records outside of the rolling window are ignored."""
+    runner = helpers.BackgroundRunner()
+    stale = runner.valuedata
+    stale["data"]["time"] = (int(time.time()) - 7200) * 1000
+    stale["data"]["current"] = 99
+    runner.write_indices(stale, helpers.data_feed_file_one)
+    runner.value = 5
+    runner.write_indices(runner.valuedata, helpers.data_feed_file_one)
+    restarted = helpers.BackgroundRunner()
+    assert restarted.recover() == 1
+    assert restarted.values == [5]
+
+
+def test_recover_no_archive(workdir):
+    """Ensure a cold start is handled."""
+    runner = helpers.BackgroundRunner()
+    assert runner.recover() == 0
+    assert runner.values == []
+    assert runner.epoch_year == 0
+
+
+def test_recover_midnight(workdir, monkeypatch):
+    """Ensure the window is refilled from the previous day's segment
+    after a restart shortly after midnight.
+    """
+    midnight = datetime(2026, 3, 2, tzinfo=timezone.utc)
+    clock = {"now": midnight}
+
+    class FakeDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock["now"]
+
+    monkeypatch.setattr(helpers, "datetime", FakeDatetime)
+    monkeypatch.setattr(
+        helpers,
+        "time",
+        SimpleNamespace(
+            time=lambda: clock["now"].timestamp(), monotonic=time.monotonic
+        ),
+    )
+    runner = helpers.BackgroundRunner()
+    # The first record falls outside of the window on restart.
+    for minutes, value in ((-40, 1), (-20, 2), (10, 3), (20, 4)):
+        clock["now"] = midnight + timedelta(minutes=minutes)
+        runner.value = value
+        runner.write_indices(runner.valuedata, helpers.data_feed_file_one)
+    assert len(list((workdir / helpers.archive).glob("*/*.jsonl"))) == 2
+    clock["now"] = midnight + timedelta(minutes=30)
+    restarted = helpers.BackgroundRunner()
+    assert restarted.recover() == 3
+    assert restarted.values == [2, 3, 4]
+    assert restarted.epoch_day == int(midnight.timestamp())
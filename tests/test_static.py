@@ -0,0 +1,100 @@
+"""Ensure static documents are served from memory."""
+
+import gzip
+import json
+import os
+import stat
+
+import pytest
+from fastapi import HTTPException, Request
+
+import helpers
+import main
+
+
+def _request(**headers) -> Request:
+    """Return a request with the given headers."""
+    return Request(
+        {
+            "type": "http",
+            "headers": [
+                (name.replace("_", "-").encode(), value.encode())
+                for name, value in headers.items()
+            ],
+        }
+    )
+
+
+def test_write_atomic(tmp_path):
+    """Ensure the document is replaced and no temporary files remain."""
+    path = tmp_path / "doc.json"
+    path.write_bytes(b"old")
+    os.chmod(path, 0o640)
+    helpers.write_atomic(str(path), b"new")
+    assert path.read_bytes() == b"new"
+    assert os.listdir(tmp_path) == ["doc.json"]
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+    new_path = tmp_path / "new.json"
+    helpers.write_atomic(str(new_path), b"new")
+    assert stat.S_IMODE(os.stat(new_path).st_mode) == 0o644
+
+
+def test_accepts_gzip():
+    """Ensure Accept-Encoding q-values are honoured."""
+    assert main.accepts_gzip("gzip")
+    assert main.accepts_gzip("deflate, gzip;q=0.5")
+    assert main.accepts_gzip("*")
+    assert not main.accepts_gzip("")
+    assert not main.accepts_gzip("gzip;q=0")
+    assert not main.accepts_gzip("gzip; q=0.0, *")
+    assert not main.accepts_gzip("identity, *;q=0")
+
+
+@pytest.mark.asyncio
+async def test_static_documents(workdir):
+    """Ensure documents are served as published with gzip variants."""
+    body = json.dumps({"feed": "data"}, indent=2).encode()
+    main.runner.publish(helpers.data_feed_file_one, body)
+    res = await main.datafeed_one(_request())
+    assert res.body == body
+    assert "content-encoding" not in res.headers
+    assert res.headers["vary"] == "Accept-Encoding"
+    res = await main.datafeed_one(_request(accept_encoding="gzip, deflate"))
+    assert res.headers["content-encoding"] == "gzip"
+    assert gzip.decompress(res.body) == body
+    res = await main.keyfile(_request())
+    assert json.loads(res.body) == main.runner.keypair.pkey_as_data()
+    res = await main.index(_request())
+    assert res.media_type == "text/html"
+
+
+@pytest.mark.asyncio
+async def test_static_conditional(workdir):
+    """Ensure conditional requests are answered with not modified."""
+    main.runner.publish(helpers.data_feed_file_one, b"{}")
+    res = await main.datafeed_one(_request())
+    etag = res.headers["etag"]
+    last_modified = res.headers["last-modified"]
+    res = await main.datafeed_one(_request(if_none_match=etag))
+    assert res.status_code == 304
+    assert res.body == b""
+    assert res.headers["etag"] == etag
+    res = await main.datafeed_one(_request(if_modified_since=last_modified))
+    assert res.status_code == 304
+    # The gzip variant is a different representation.
+    res = await main.datafeed_one(_request(accept_encoding="gzip", if_none_match=etag))
+    assert res.status_code == 200
+    assert res.headers["etag"] != etag
+    main.runner.publish(helpers.data_feed_file_one, b'{"new": 1}')
+    res = await main.datafeed_one(_request(if_none_match=etag))
+    assert res.status_code == 200
+    assert res.headers["etag"] != etag
+
+
+@pytest.mark.asyncio
+async def test_static_document_missing():
+    """Ensure documents not yet published are not found."""
+    main.runner.documents.pop(helpers.data_feed_file_two, None)
+    with pytest.raises(HTTPException) as err:
+        await main.datafeed_two(_request())
+    assert err.value.status_code == 404